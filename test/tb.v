@@ -14,7 +14,7 @@ module tb ();
   end
 
   // Wire up the inputs and outputs:
-  reg clk;
+  reg clk = 1'b0;
   reg rst_n;
   reg ena;
   reg [7:0] ui_in;
@@ -27,6 +27,29 @@ module tb ();
   wire VGND = 1'b0;
 `endif
 
+  // 10 MHz system clock (100 ns period). Generated here rather than by a
+  // cocotb Clock so it runs once for the whole simulation: cocotb kills the
+  // tasks each test forks when that test ends.
+  always #50 clk = ~clk;
+
+  // SPI SCLK generator: while sclk_en is high, toggle sclk every 5 us
+  // (100 kHz). sclk is ORed onto ui_in[0] so the cocotb test only has to
+  // update COPI and nCS on each falling edge.
+  reg sclk_en = 1'b0;
+  reg sclk = 1'b0;
+
+  always @(posedge sclk_en) begin : sclk_gen
+    forever begin
+      #5000 sclk = 1'b1;
+      #5000 sclk = 1'b0;
+    end
+  end
+
+  always @(negedge sclk_en) begin
+    disable sclk_gen;
+    sclk = 1'b0;
+  end
+
   // Replace tt_um_example with your module name:
   tt_um_uwasic_onboarding_jeremy_zheng user_project(
 
@@ -36,7 +59,7 @@ module tb ();
       .VGND(VGND),
 `endif
 
-      .ui_in  (ui_in),    // Dedicated inputs
+      .ui_in  ({ui_in[7:1], ui_in[0] | sclk}),    // Dedicated inputs
       .uo_out (uo_out),   // Dedicated outputs
       .uio_in (uio_in),   // IOs: Input path
       .uio_out(uio_out),  // IOs: Output path